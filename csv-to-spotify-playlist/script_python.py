@@ -6,7 +6,14 @@ import requests
 import json
 import csv
 import re
+import unicodedata
+import difflib
 import logging
+import argparse
+import threading
+import contextlib
+import cProfile
+import pstats
 from pathlib import Path
 from dotenv import load_dotenv
 import concurrent.futures
@@ -16,38 +23,158 @@ logging.basicConfig(level=logging.INFO, format='[%(levelname)s] %(message)s')
 load_dotenv()
 CLIENT_ID = os.getenv("CLIENT_ID")
 CLIENT_SECRET = os.getenv("CLIENT_SECRET")
+SEARCH_CANDIDATES = 5       # candidats demandés par requête de recherche
+SEARCH_CALL_BUDGET = 3      # nombre maximal de requêtes de recherche par ligne CSV
+MATCH_ACCEPT_SCORE = 0.85   # score à partir duquel on arrête la relaxation
+MATCH_MIN_SCORE = 0.7       # score minimal pour retenir un candidat
+MATCH_MIN_TITLE_SCORE = 0.85  # en dessous, titre différent : candidat rejeté
+MATCH_MIN_ARTIST_SCORE = 0.8  # en dessous, artiste différent : candidat rejeté
+VERSION_MISMATCH_PENALTY = 0.1  # edit, mix, remaster... : la version simple passe devant
+
+# --- Tracing / Profiling ---
+class Tracer:
+    """Collecte des spans et les exporte au format Chrome trace-event (chrome://tracing, Perfetto)."""
+    def __init__(self):
+        self.events = []
+        self.thread_names = {}
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+    def record(self, name, cat, start_us, end_us, args):
+        thread = threading.current_thread()
+        event = {
+            "name": name, "cat": cat, "ph": "X",
+            "ts": start_us, "dur": end_us - start_us,
+            "pid": self.pid, "tid": thread.ident, "args": args,
+        }
+        with self.lock:
+            self.events.append(event)
+            self.thread_names.setdefault(thread.ident, thread.name)
+    def write(self, path):
+        with self.lock:
+            metadata = [
+                {"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                for tid, name in self.thread_names.items()
+            ]
+            events = metadata + sorted(self.events, key=lambda e: e["ts"])
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        logging.info(f"Trace written to {path} ({len(events)} events)")
+
+class _Span:
+    __slots__ = ("tracer", "name", "cat", "args", "start")
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+    def annotate(self, **args):
+        self.args.update(args)
+    def __enter__(self):
+        self.start = time.perf_counter_ns() // 1000
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args["error"] = exc_type.__name__
+        self.tracer.record(self.name, self.cat, self.start, time.perf_counter_ns() // 1000, self.args)
+        return False
+
+class _NullSpan:
+    __slots__ = ()
+    def annotate(self, **args):
+        pass
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+_NULL_SPAN = _NullSpan()
+_tracer = None
+_profiles = None
+
+def enable_tracing():
+    global _tracer
+    _tracer = Tracer()
+    return _tracer
+
+def enable_profiling():
+    global _profiles
+    _profiles = {}
+
+def span(name, cat="app", **args):
+    # Tracing désactivé : un seul test, aucun objet alloué
+    if _tracer is None:
+        return _NULL_SPAN
+    return _Span(_tracer, name, cat, args)
+
+@contextlib.contextmanager
+def phase(name, **args):
+    """Span de phase ; avec --profile, cumule aussi un cProfile par phase.
+
+    Les phases ne doivent pas s'imbriquer : un seul cProfile peut être actif à la fois.
+    N'y mettre que du travail fait dans le thread appelant : cProfile tient une seule pile
+    d'appels et ne sait pas attribuer le travail des threads de recherche.
+    """
+    profiler = None
+    if _profiles is not None:
+        profiler = _profiles.setdefault(name, cProfile.Profile())
+    with span(name, cat="phase", **args):
+        if profiler is None:
+            yield
+            return
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+
+def write_profiles(directory, top=15):
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    for name, profiler in _profiles.items():
+        path = directory / f"{name}.prof"
+        profiler.dump_stats(path)
+        print(f"\n--- Profil de la phase '{name}' ({path}) ---")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(top)
 
 # --- Utilitaires génériques ---
+def retry_sleep(seconds, reason):
+    with span("retry_sleep", cat="retry", seconds=seconds, reason=reason):
+        time.sleep(seconds)
+
 def http_request(method, url, headers=None, data=None, params=None, max_retries=3, timeout=10):
     for attempt in range(1, max_retries + 1):
         try:
-            if method == 'GET':
-                resp = requests.get(url, headers=headers, params=params, timeout=timeout)
-            elif method == 'POST':
-                resp = requests.post(url, headers=headers, data=data, params=params, timeout=timeout)
-            elif method == 'PUT':
-                resp = requests.put(url, headers=headers, data=data, params=params, timeout=timeout)
-            else:
-                raise ValueError(f"Unsupported HTTP method: {method}")
+            with span(f"{method} {url.split('?', 1)[0]}", cat="http", attempt=attempt) as sp:
+                resp = _send(method, url, headers, data, params, timeout)
+                sp.annotate(status=resp.status_code)
             
             # Gestion du rate limit Spotify (429)
             if resp.status_code == 429:
                 retry_after = int(resp.headers.get("Retry-After", "5"))
                 print(f"\n")
                 logging.warning(f"Rate limited by Spotify (429). Waiting {retry_after} seconds before retrying...")
-                time.sleep(3 ** retry_after)
+                retry_sleep(3 ** retry_after, "429")
                 continue
             if resp.status_code >= 500:
                 logging.warning(f"HTTP {resp.status_code} on {url}, retrying ({attempt}/{max_retries})...")
-                time.sleep(2 ** attempt)
+                retry_sleep(2 ** attempt, str(resp.status_code))
                 continue
             return resp
         except requests.RequestException as e:
             logging.warning(f"Request error: {e}, retrying ({attempt}/{max_retries})...")
-            time.sleep(2 ** attempt)
+            retry_sleep(2 ** attempt, type(e).__name__)
     logging.error(f"Failed to {method} {url} after {max_retries} attempts.")
     raise RuntimeError(f"HTTP request failed: {method} {url}")
 
+def _send(method, url, headers, data, params, timeout):
+    if method == 'GET':
+        return requests.get(url, headers=headers, params=params, timeout=timeout)
+    elif method == 'POST':
+        return requests.post(url, headers=headers, data=data, params=params, timeout=timeout)
+    elif method == 'PUT':
+        return requests.put(url, headers=headers, data=data, params=params, timeout=timeout)
+    raise ValueError(f"Unsupported HTTP method: {method}")
+
 def update_env_refresh_token(refresh_token, path=None):
     if path is None:
         base_dir = Path(__file__).parent
@@ -207,16 +334,149 @@ def updating_playlist_name(token, playlist_id, new_name):
     else:
         logging.info(f"Renamed playlist to '{new_name}' (id: {playlist_id})")
 
-def search_the_song(token, artist_name, track_name):
-    query = f"track:{track_name} artist:{artist_name}"
-    url = f"https://api.spotify.com/v1/search?q={requests.utils.quote(query)}&type=track&limit=1"
+def search_tracks(token, query, limit=SEARCH_CANDIDATES):
+    url = f"https://api.spotify.com/v1/search?q={requests.utils.quote(query)}&type=track&limit={limit}"
     headers = get_auth_header(token)
     result = http_request('GET', url, headers=headers)
     json_result = result.json()
-    tracks = json_result.get("tracks", {}).get("items")
-    if tracks:
-        return tracks[0]
-    return None
+    return json_result.get("tracks", {}).get("items") or []
+
+# --- Résolution des tracks (normalisation + score local) ---
+_FEAT_RE = re.compile(r"\s*[\(\[]\s*(?:feat\.?|ft\.?|featuring|with)\s[^\)\]]*[\)\]]|\s+(?:feat\.?|ft\.?|featuring)\s.*$", re.IGNORECASE)
+_VERSION_WORDS = r"\b(?:remix|edit|version|remaster(?:ed)?|live|mix|extended|acoustic|instrumental|mono|stereo)\b"
+_VERSION_RE = re.compile(
+    rf"\s*[\(\[][^\)\]]*{_VERSION_WORDS}[^\)\]]*[\)\]]|\s+-\s+[^-]*{_VERSION_WORDS}.*$",
+    re.IGNORECASE)
+_VERSION_WORD_RE = re.compile(_VERSION_WORDS, re.IGNORECASE)
+_REMIX_RE = re.compile(r"\bremix\b", re.IGNORECASE)
+# Un autre enregistrement que le studio : jamais la même track
+_DISTINCT_VERSIONS = frozenset({"remix", "live", "acoustic", "instrumental"})
+# " x " seulement entre deux espaces ("X Ambassadors"), et jamais "/" ("AC/DC")
+_ARTIST_SPLIT_RE = re.compile(r"\s*(?:,|&|;|\+|(?<=\s)x(?=\s)|\bfeat\b\.?|\bft\b\.?|\bfeaturing\b|\band\b|\bet\b)\s*", re.IGNORECASE)
+_ISRC_RE = re.compile(r"^[A-Z]{2}[A-Z0-9]{3}\d{7}$")
+_NON_ALNUM_RE = re.compile(r"[^0-9a-z]+")
+
+def normalize_text(text):
+    """Minuscules, sans accents ni ponctuation, espaces compactés."""
+    text = unicodedata.normalize("NFKD", text or "")
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return _NON_ALNUM_RE.sub(" ", text.lower()).strip()
+
+def base_title(title):
+    """Titre sans mentions 'feat.' ni suffixes de version ('(Radio Edit)', '- 2011 Remaster'...)."""
+    stripped = _VERSION_RE.sub("", _FEAT_RE.sub("", title or "")).strip()
+    return stripped or (title or "").strip()
+
+def version_tags(title):
+    """Marqueurs de version du titre ('(Live)', '- Radio Edit'...), hors mots du titre lui-même."""
+    title = _FEAT_RE.sub("", title or "")
+    tags = {w.lower().replace("remastered", "remaster")
+            for m in _VERSION_RE.finditer(title) for w in _VERSION_WORD_RE.findall(m.group())}
+    if _REMIX_RE.search(title):
+        tags.add("remix")
+    return frozenset(tags)
+
+def split_artists(artists):
+    return [normalize_text(a) for a in _ARTIST_SPLIT_RE.split(artists or "") if normalize_text(a)]
+
+def normalize_isrc(isrc):
+    """ISRC en majuscules, ou None si la colonne contient autre chose (id Deezer, vide...)."""
+    isrc = (isrc or "").strip().upper()
+    return isrc if _ISRC_RE.match(isrc) else None
+
+def _similarity(a, b):
+    if not a or not b:
+        return 0.0
+    if a == b:
+        return 1.0
+    ratio = difflib.SequenceMatcher(None, a, b).ratio()
+    tokens_a, tokens_b = set(a.split()), set(b.split())
+    overlap = len(tokens_a & tokens_b) / max(len(tokens_a), len(tokens_b))
+    return max(ratio, overlap * 0.95)
+
+class TrackQuery:
+    """Ligne CSV normalisée une seule fois, réutilisée pour toutes les requêtes et tous les candidats."""
+    def __init__(self, track_name, artist_name, album=None, isrc=None):
+        self.track_name = track_name
+        self.artist_name = artist_name
+        self.base_title = base_title(track_name)
+        self.title_norm = normalize_text(self.base_title)
+        self.full_artist = normalize_text(artist_name)
+        self.artists = split_artists(artist_name)
+        self.primary_artist = next((a.strip() for a in _ARTIST_SPLIT_RE.split(artist_name or "") if a.strip()), "")
+        self.album_norm = normalize_text(album)
+        self.isrc = normalize_isrc(isrc)
+        self.versions = version_tags(track_name)
+
+    def queries(self):
+        """Échelle de relaxation : de la requête la plus stricte à la plus large."""
+        # Un '"' dans un titre casserait les filtres track:"..." / artist:"..."
+        title = self.base_title.replace('"', "")
+        primary_artist = self.primary_artist.replace('"', "")
+        artist_name = (self.artist_name or "").replace('"', "").strip()
+        ladder = []
+        if self.isrc:
+            ladder.append(f"isrc:{self.isrc}")
+        if primary_artist:
+            ladder.append(f'track:"{title}" artist:"{primary_artist}"')
+            ladder.append(f"{title} {artist_name}")
+        ladder.append(f'track:"{title}"')
+        return ladder
+
+    def artist_score(self, candidate_artists):
+        """Le nom complet d'abord ; un fragment ('Fire' dans 'Earth, Wind & Fire') ne compte
+        que si le candidat crédite lui-même plusieurs artistes."""
+        score = max((_similarity(self.full_artist, c) for c in candidate_artists), default=0.0)
+        if len(candidate_artists) > 1:
+            score = max([score] + [_similarity(a, c) for a in self.artists for c in candidate_artists])
+        return score
+
+    def score(self, track):
+        if self.isrc and ((track.get("external_ids") or {}).get("isrc") or "").upper() == self.isrc:
+            return 1.0
+        version_mismatch = self.versions ^ version_tags(track.get("name"))
+        if version_mismatch & _DISTINCT_VERSIONS:
+            return 0.0
+        title_score = _similarity(self.title_norm, normalize_text(base_title(track.get("name"))))
+        if title_score < MATCH_MIN_TITLE_SCORE:
+            return 0.0
+        candidate_artists = [normalize_text((a or {}).get("name")) for a in track.get("artists") or []]
+        artist_score = self.artist_score([c for c in candidate_artists if c])
+        if artist_score < MATCH_MIN_ARTIST_SCORE:
+            return 0.0
+        if self.album_norm:
+            album_score = _similarity(self.album_norm, normalize_text(base_title((track.get("album") or {}).get("name"))))
+            score = 0.55 * title_score + 0.35 * artist_score + 0.10 * album_score
+        else:
+            score = 0.6 * title_score + 0.4 * artist_score
+        if version_mismatch:
+            score -= VERSION_MISMATCH_PENALTY
+        return score
+
+def resolve_track(token, query: TrackQuery, budget=SEARCH_CALL_BUDGET):
+    """Retourne (track ou None, score, nombre de requêtes effectuées)."""
+    best, best_score, calls = None, 0.0, 0
+    seen = set()
+    for q in query.queries()[:budget]:
+        calls += 1
+        try:
+            tracks = search_tracks(token, q)
+        except (RuntimeError, ValueError) as e:
+            # On garde le meilleur candidat des requêtes précédentes
+            logging.warning(f"Search failed for query {q!r}: {e}")
+            continue
+        for track in tracks:
+            if not track or track.get("id") in seen:
+                continue
+            seen.add(track.get("id"))
+            score = query.score(track)
+            if score > best_score:
+                best, best_score = track, score
+        if best_score >= MATCH_ACCEPT_SCORE:
+            break
+    if best_score < MATCH_MIN_SCORE:
+        return None, best_score, calls
+    return best, best_score, calls
 
 def add_tracks_to_playlist_batch(token, playlist_id, track_uris, processed_songs=None, total_songs=None):
     url = f"https://api.spotify.com/v1/playlists/{playlist_id}/tracks"
@@ -243,6 +503,7 @@ class Stats:
         self.tracks_already_present = 0
         self.tracks_not_found = 0
         self.files_skipped = 0
+        self.search_calls = 0
     def print_summary(self):
         print("\n")
         print("\n--- Résumé de la synchronisation Spotify ---")
@@ -252,10 +513,25 @@ class Stats:
         print(f"Tracks déjà présents : {self.tracks_already_present}")
         print(f"Tracks non trouvés : {self.tracks_not_found}")
         print(f"Fichiers CSV ignorés (playlist déjà complète) : {self.files_skipped}")
+        print(f"Requêtes de recherche : {self.search_calls}")
         print("-------------------------------------------\n")
 
 # --- Traitement principal d'un fichier CSV ---
 def process_file(token, playlists_concern, csv_path: Path, stats: 'Stats', processed_files=None, total_files=None):
+    with span("process_file", cat="file", file=csv_path.name):
+        _process_file(token, playlists_concern, csv_path, stats, processed_files, total_files)
+
+def _traced_resolve(token, query):
+    with span("resolve_track", cat="search", track=query.track_name, artist=query.artist_name) as sp:
+        track, score, calls = resolve_track(token, query)
+        sp.annotate(found=track is not None, score=round(score, 3), calls=calls)
+        return track, calls
+
+def read_csv_tracks(file):
+    """Lignes de tracks du CSV, sans les 3 premières lignes."""
+    return list(csv.reader(file))[3:]
+
+def _process_file(token, playlists_concern, csv_path, stats, processed_files, total_files):
     title = csv_path.stem
     title_without_date = re.sub(r'-\d{2}-\d{2}-\d{4}$', '', title)
     if processed_files is not None and total_files is not None:
@@ -271,32 +547,40 @@ def process_file(token, playlists_concern, csv_path: Path, stats: 'Stats', proce
             track_ids_set = info["track_ids"]
             playlist_found = True
             if name != title_without_date:
-                updating_playlist_name(token, playlist_id, title_without_date)
+                with phase("updating_playlist_name"):
+                    updating_playlist_name(token, playlist_id, title_without_date)
                 stats.playlists_updated += 1
             break
     if not playlist_found:
-        playlist = create_playlist(token, title_without_date)
+        with phase("create_playlist"):
+            playlist = create_playlist(token, title_without_date)
         playlist_id = playlist["id"]
         track_ids_set = set()
         playlists_concern[title_without_date] = {"id": playlist_id, "track_ids": track_ids_set}
         stats.playlists_created += 1
     with csv_path.open('r') as file:
-        csv_reader = list(csv.reader(file))
-        lines = csv_reader[3:]
+        lines = read_csv_tracks(file)
         total_songs = len(lines)
         if len(track_ids_set) >= total_songs:
             logging.info(f"Playlist '{title_without_date}' already has {len(track_ids_set)} tracks (CSV: {total_songs}), skipping.\n\n")
             stats.files_skipped += 1
             return
-        search_args = [(token, row[1], row[0]) for row in lines]
+        queries = []
+        for row in lines:
+            album = row[2] if len(row) > 2 else None
+            isrc = row[5] if len(row) > 5 else None
+            queries.append(TrackQuery(row[0], row[1], album, isrc))
         results = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-            future_to_idx = {executor.submit(search_the_song, *args): idx for idx, args in enumerate(search_args)}
+        # Simple span : le travail se fait dans les threads de recherche, voir --trace
+        with span("search_fanout", cat="phase", rows=len(lines)), \
+                concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="search") as executor:
+            future_to_idx = {executor.submit(_traced_resolve, token, query): idx for idx, query in enumerate(queries)}
             results = [None] * len(lines)
             for future in concurrent.futures.as_completed(future_to_idx):
                 idx = future_to_idx[future]
                 try:
-                    results[idx] = future.result()
+                    results[idx], calls = future.result()
+                    stats.search_calls += calls
                 except Exception as exc:
                     results[idx] = None
                     logging.warning(f"Track search failed at line {idx+4} in {csv_path.name}: {exc}")
@@ -318,12 +602,33 @@ def process_file(token, playlists_concern, csv_path: Path, stats: 'Stats', proce
                 logging.warning(f"Not found: {track_name} by {artist_name} in file: {csv_path.name}")
                 stats.tracks_not_found += 1
         if to_add_uris:
-            add_tracks_to_playlist_batch(token, playlist_id, to_add_uris, processed_songs=processed_songs, total_songs=total_songs)
+            with phase("add_tracks_to_playlist_batch", uris=len(to_add_uris)):
+                add_tracks_to_playlist_batch(token, playlist_id, to_add_uris, processed_songs=processed_songs, total_songs=total_songs)
         else:
             logging.info(f"No new tracks to add for playlist '{title_without_date}'\n")
 
 # --- Orchestration globale ---
-def main():
+def main(trace_path=None, profile_dir=None):
+    if trace_path:
+        enable_tracing()
+    if profile_dir:
+        enable_profiling()
+    try:
+        run()
+    finally:
+        # Une erreur d'écriture ne doit pas masquer l'exception qui a interrompu run()
+        if trace_path:
+            try:
+                _tracer.write(trace_path)
+            except Exception as e:
+                logging.error(f"Failed to write trace to {trace_path}: {e}")
+        if profile_dir:
+            try:
+                write_profiles(profile_dir)
+            except Exception as e:
+                logging.error(f"Failed to write profiles to {profile_dir}: {e}")
+
+def run():
     directory = Path("/Users/laurent/Downloads/CSV-to-spotify-playlist/csv-to-spotify-playlist")
     csv_files = list(directory.glob("*.csv"))
     redirect_uri = "https://www.google.co.in/"
@@ -332,7 +637,8 @@ def main():
     new_refresh_token = None
     if refresh_token:
         try:
-            token, new_refresh_token = get_token_with_refresh(CLIENT_ID, CLIENT_SECRET, refresh_token)
+            with phase("get_token_with_refresh"):
+                token, new_refresh_token = get_token_with_refresh(CLIENT_ID, CLIENT_SECRET, refresh_token)
             logging.info("Obtained access_token via refresh_token.")
             if new_refresh_token and new_refresh_token != refresh_token:
                 update_env_refresh_token(new_refresh_token)
@@ -345,13 +651,22 @@ def main():
     if not token:
         logging.error("❌ Failed to obtain a valid user token. Exiting.")
         return
-    playlists_concern = get_all_playlists_with_tracks(token)
+    with phase("get_all_playlists_with_tracks"):
+        playlists_concern = get_all_playlists_with_tracks(token)
     stats = Stats()
     total_files = len(csv_files)
-    for processed_files, csv_path in enumerate(csv_files, 1):
-        process_file(token, playlists_concern, csv_path, stats, processed_files=processed_files, total_files=total_files)
+    # Simple span : les phases profilées (recherche, création, ajout) sont à l'intérieur
+    with span("process_files", cat="phase", files=total_files):
+        for processed_files, csv_path in enumerate(csv_files, 1):
+            process_file(token, playlists_concern, csv_path, stats, processed_files=processed_files, total_files=total_files)
     stats.print_summary()
 
 # --- Point d'entrée ---
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Synchronise les exports CSV avec des playlists Spotify.")
+    parser.add_argument("--trace", metavar="OUT_JSON",
+                        help="Enregistre les spans (phases, fichiers, appels HTTP, attentes de retry) au format Chrome trace-event")
+    parser.add_argument("--profile", metavar="DIR", nargs="?", const="profiles",
+                        help="Profile chaque phase avec cProfile et écrit <phase>.prof dans DIR (défaut : profiles)")
+    args = parser.parse_args()
+    main(trace_path=args.trace, profile_dir=args.profile)
@@ -0,0 +1,215 @@
+import csv
+import json
+import threading
+from pathlib import Path
+
+import pytest
+
+import script_python as sp
+
+HERE = Path(__file__).parent
+SAMPLE_CSVS = [
+    "Afro Hits-06-06-2025.csv",
+    "Dancehall & Afro beats-06-06-2025.csv",
+    "Dancehall   Mix 2020 _ Best Dancehall Official 2020 ft. Koffee (W) Toast _Best Reggae Soca 2019-06-06-2025.csv",
+]
+
+
+def load_rows(name):
+    with (HERE / name).open('r') as file:
+        return sp.read_csv_tracks(file)
+
+
+def make_track(name, artists, album="", isrc="", track_id="1"):
+    return {
+        "id": track_id,
+        "name": name,
+        "artists": [{"name": a} for a in artists],
+        "album": {"name": album},
+        "external_ids": {"isrc": isrc},
+    }
+
+
+@pytest.mark.parametrize("csv_name", SAMPLE_CSVS)
+def test_sample_rows_accept_their_own_listing(csv_name):
+    for row in load_rows(csv_name):
+        query = sp.TrackQuery(row[0], row[1], row[2], None)
+        # Spotify crédite chaque artiste séparément...
+        credited = [a for a in sp._ARTIST_SPLIT_RE.split(row[1]) if a.strip()]
+        assert query.score(make_track(row[0], credited, row[2])) >= sp.MATCH_ACCEPT_SCORE, row
+        # ... ou le nom complet, et liste souvent le titre sans '(feat. ...)'
+        without_feat = sp._FEAT_RE.sub("", row[0])
+        assert query.score(make_track(without_feat, [row[1], "Someone Else"])) >= sp.MATCH_ACCEPT_SCORE, row
+
+
+@pytest.mark.parametrize("track_name, artist_name, candidate", [
+    ("Love Me", "Rema", make_track("Love You", ["Rema"])),
+    ("Hello", "Adele", make_track("Hello", ["Adele Something"])),
+    ("Ojuelegba", "Wizkid", make_track("Ojuelegba (Remix)", ["Wizkid"])),
+    ("Lonely At The Top (Remix)", "Asake", make_track("Lonely At The Top", ["Asake"])),
+    ("KANTE (feat. Fave)", "Davido", make_track("KANTE (feat. Fave)", ["Fave"])),
+    ("September", "Earth, Wind & Fire", make_track("September", ["Fire"])),
+    ("The Boxer", "Simon & Garfunkel", make_track("The Boxer", ["Simon"])),
+    ("Is This Love", "Bob Marley & The Wailers", make_track("Is This Love", ["The Wailers"])),
+    ("Essence", "Wizkid", make_track("Essence - Live", ["Wizkid"])),
+    ("Essence (Live)", "Wizkid", make_track("Essence", ["Wizkid"])),
+    ("Joro", "Wizkid", make_track("Joro (Instrumental)", ["Wizkid"])),
+    ("Joro", "Wizkid", make_track("Joro - Acoustic Version", ["Wizkid"])),
+])
+def test_different_song_is_rejected(track_name, artist_name, candidate):
+    query = sp.TrackQuery(track_name, artist_name)
+    assert query.score(candidate) < sp.MATCH_MIN_SCORE
+
+
+@pytest.mark.parametrize("title, expected", [
+    ("With You (feat. Omah Lay)", "With You"),
+    ("soso (with Ozuna)", "soso"),
+    ("Naughty Gyal (Original Mix)", "Naughty Gyal"),
+    ("Differ (feat. Sean Paul, Agent Sasco & Chi Ching Ching) (Remix)", "Differ"),
+    ("Kese (Dance)", "Kese (Dance)"),
+])
+def test_base_title(title, expected):
+    assert sp.base_title(title) == expected
+
+
+@pytest.mark.parametrize("artists, primary, expected", [
+    ("X Ambassadors", "X Ambassadors", ["x ambassadors"]),
+    ("AC/DC", "AC/DC", ["ac dc"]),
+    ("Tyler, The Creator", "Tyler", ["tyler", "the creator"]),
+    ("Tems x Wizkid", "Tems", ["tems", "wizkid"]),
+    ("Burna Boy feat. Featherstone", "Burna Boy", ["burna boy", "featherstone"]),
+])
+def test_artist_splitting(artists, primary, expected):
+    query = sp.TrackQuery("Song", artists)
+    assert query.primary_artist == primary
+    assert query.artists == expected
+
+
+def test_full_artist_string_matches_candidate():
+    query = sp.TrackQuery("EARFQUAKE", "Tyler, The Creator")
+    assert query.score(make_track("EARFQUAKE", ["Tyler, The Creator"])) >= sp.MATCH_ACCEPT_SCORE
+    band = sp.TrackQuery("September", "Earth, Wind & Fire")
+    assert band.score(make_track("September", ["Earth, Wind & Fire"])) >= sp.MATCH_ACCEPT_SCORE
+    # Fragment accepté seulement si le candidat crédite plusieurs artistes
+    duo = sp.TrackQuery("Run di place", "Bamby & Jahyanai King")
+    assert duo.score(make_track("Run di place", ["Jahyanai King", "Bamby"])) >= sp.MATCH_ACCEPT_SCORE
+
+
+def test_minor_version_mismatch_loses_to_plain_version():
+    query = sp.TrackQuery("Essence", "Wizkid")
+    plain = query.score(make_track("Essence", ["Wizkid"]))
+    edit = query.score(make_track("Essence - Radio Edit", ["Wizkid"]))
+    assert sp.MATCH_MIN_SCORE <= edit < plain
+    assert sp.TrackQuery("Hold On (Radio Edit)", "X").score(make_track("Hold On - Radio Edit", ["X"])) == 1.0
+    # Un mot du titre n'est pas un marqueur de version
+    assert sp.version_tags("Live Your Life") == frozenset()
+
+
+def test_null_fields_from_api_are_tolerated():
+    query = sp.TrackQuery("With You", "Davido", "5ive", "GBARL2401834")
+    track = {"id": "1", "name": "With You", "artists": [{"name": "Davido"}], "album": None, "external_ids": None}
+    assert query.score(track) >= sp.MATCH_ACCEPT_SCORE
+    track.update(external_ids={"isrc": None}, artists=None)
+    assert query.score(track) == 0.0
+
+
+def test_quotes_do_not_break_field_filters():
+    query = sp.TrackQuery('Say "Hi" (feat. Rema)', 'Big "B"')
+    assert query.queries() == ['track:"Say Hi" artist:"Big B"', "Say Hi Big B", 'track:"Say Hi"']
+
+
+def test_isrc_only_used_when_valid():
+    deezer_id = sp.TrackQuery("Song", "Artist", None, "2537754501")
+    assert deezer_id.isrc is None
+    assert not any(q.startswith("isrc:") for q in deezer_id.queries())
+    assert deezer_id.score(make_track("Other", ["Nobody"], isrc="2537754501")) == 0.0
+
+    # 'Original Koffee' (libellé Deezer) ne ressemble pas à 'Koffee' : seul l'ISRC fait le lien
+    row = ["W (feat. Gunna)", "Original Koffee", "W (feat. Gunna)", "GBARL1901308"]
+    query = sp.TrackQuery(row[0], row[1], row[2], row[3].lower())
+    assert query.queries()[0] == "isrc:GBARL1901308"
+    assert query.score(make_track("W (feat. Gunna)", ["Koffee", "Gunna"], isrc="GBARL1901308")) == 1.0
+
+
+def test_resolve_track_keeps_best_when_a_later_query_fails(monkeypatch):
+    query = sp.TrackQuery("With You (feat. Omah Lay)", "Davido", "5ive")
+    found = make_track("With You", ["Davido"], "Compilation 2024")
+    # Seuil d'acceptation inatteignable : l'échelle est parcourue jusqu'au bout du budget
+    monkeypatch.setattr(sp, "MATCH_ACCEPT_SCORE", 1.01)
+    responses = [[found], RuntimeError("HTTP request failed"), []]
+
+    def fake_search(token, q, limit=sp.SEARCH_CANDIDATES):
+        result = responses.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    monkeypatch.setattr(sp, "search_tracks", fake_search)
+    track, score, calls = sp.resolve_track("token", query)
+    assert track is found
+    assert score >= sp.MATCH_MIN_SCORE
+    assert calls == 3
+
+
+@pytest.fixture
+def tracing(monkeypatch):
+    monkeypatch.setattr(sp, "_tracer", None)
+    monkeypatch.setattr(sp, "_profiles", None)
+    return sp.enable_tracing()
+
+
+def test_span_is_null_when_tracing_disabled(monkeypatch):
+    monkeypatch.setattr(sp, "_tracer", None)
+    assert sp.span("GET /v1/search", cat="http", attempt=1) is sp._NULL_SPAN
+
+
+def test_tracer_writes_chrome_trace(tracing, tmp_path):
+    with sp.span("process_file", cat="file", file="a.csv") as span:
+        span.annotate(rows=3)
+    def search_worker():
+        with sp.span("resolve_track", cat="search"):
+            pass
+
+    worker = threading.Thread(target=search_worker, name="search_0")
+    worker.start()
+    worker.join()
+    with pytest.raises(KeyError):
+        with sp.span("create_playlist", cat="playlist"):
+            raise KeyError("id")
+
+    path = tmp_path / "trace.json"
+    tracing.write(path)
+    events = json.loads(path.read_text())["traceEvents"]
+    spans = {e["name"]: e for e in events if e["ph"] == "X"}
+    assert set(spans) == {"process_file", "resolve_track", "create_playlist"}
+    for event in spans.values():
+        assert isinstance(event["ts"], int) and isinstance(event["dur"], int) and event["dur"] >= 0
+    assert spans["process_file"]["args"] == {"file": "a.csv", "rows": 3}
+    assert spans["create_playlist"]["args"]["error"] == "KeyError"
+    names = {e["tid"]: e["args"]["name"] for e in events if e["ph"] == "M" and e["name"] == "thread_name"}
+    assert names[spans["resolve_track"]["tid"]] == "search_0"
+    assert names[spans["process_file"]["tid"]] == threading.current_thread().name
+
+
+def test_phase_accumulates_one_profile_per_name(tracing):
+    sp.enable_profiling()
+    for _ in range(2):
+        with sp.phase("create_playlist"):
+            sorted(range(10))
+    with sp.phase("add_tracks_to_playlist_batch"):
+        pass
+    assert set(sp._profiles) == {"create_playlist", "add_tracks_to_playlist_batch"}
+    stats = sp.pstats.Stats(sp._profiles["create_playlist"])
+    sorted_calls = [v[1] for k, v in stats.stats.items() if k[2] == "<built-in method builtins.sorted>"]
+    assert sorted_calls == [2]
+
+
+def test_main_keeps_run_error_when_trace_write_fails(monkeypatch, tmp_path):
+    monkeypatch.setattr(sp, "_tracer", None)
+
+    def failing_run():
+        raise KeyError("original")
+
+    monkeypatch.setattr(sp, "run", failing_run)
+    with pytest.raises(KeyError, match="original"):
+        sp.main(trace_path=tmp_path / "missing" / "trace.json")